@@ -6,14 +6,15 @@ JP Full Trade Visualization Pipeline (EXPORT + IMPORT)
 ------------------------------------------------------
 
 Updated to match jp_pull_and_run_trade_pipeline.py:
-- Reads combined import + export dataset
+- Streams the combined import + export dataset (Parquet, or its CSV copy) in chunks
 - Splits into EXPORT and IMPORT
 - Applies HS10 → (US_Group, NATO_Class, MTOW) mapping
 - Translates JP country names → English
 - Creates qtr and period variables (TW-style)
-- Saves:
-      JP_cleaned_export_by_hs10.csv
-      JP_cleaned_import_by_hs10.csv
+- Saves (Parquet, keeps categorical dtypes for the plot scripts):
+      JP_cleaned_export_by_hs10.parquet
+      JP_cleaned_import_by_hs10.parquet
+  plus optional CSV copies when WRITE_CSV is set
 - Runs all plots using jp_plot_01_to_02 and jp_plot_03_to_06
 
 This is the synchronized counterpart of TW full_hs10_plot_script_v2.
@@ -21,8 +22,14 @@ This is the synchronized counterpart of TW full_hs10_plot_script_v2.
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from pathlib import Path
-import subprocess
+
+import jp_plot_common
+import jp_plot_01_to_02
+import jp_plot_03_to_06
 
 # ================================================================
 # 0. Directories (same as pipeline)
@@ -31,10 +38,15 @@ BASE_DIR = Path(
     "~/Library/Mobile Documents/com~apple~CloudDocs/github/drone-export-jp"
 ).expanduser()
 
-INPUT_FILE = BASE_DIR / "jp_trade_export_import_8806_monthly.csv"
+# Combined dataset from jp_pull_and_run_pipeline (CSV copy as fallback)
+INPUT_FILE = BASE_DIR / "jp_trade_export_import_8806_monthly.parquet"
+INPUT_CSV = INPUT_FILE.with_suffix(".csv")
+
+# One cleaned file per flow: JP_cleaned_export_… / JP_cleaned_import_…
+OUT_CLEAN = "JP_cleaned_{flow}_by_hs10.parquet"
 
-OUT_EXPORT = BASE_DIR / "JP_cleaned_export_by_hs10.csv"
-OUT_IMPORT = BASE_DIR / "JP_cleaned_import_by_hs10.csv"
+# Also write human-readable CSV copies next to the Parquet files
+WRITE_CSV = False
 
 ENC = "utf-8-sig"
 
@@ -56,8 +68,11 @@ hs10_group_class_map_jp = {
     "8806.99.00.00": ("Group 4/5", "Class III", ">150kg"),
 }
 
-def map_hs10_to_tuple(hs):
-    return hs10_group_class_map_jp.get(hs, (None, None, None))
+# Pre-split into one dict per output column so each can be applied with a
+# single vectorized Series.map instead of a per-row apply
+HS10_GROUP = {k: v[0] for k, v in hs10_group_class_map_jp.items()}
+HS10_CLASS = {k: v[1] for k, v in hs10_group_class_map_jp.items()}
+HS10_MTOW = {k: v[2] for k, v in hs10_group_class_map_jp.items()}
 
 # ================================================================
 # 2. JP → English Country Name mapping
@@ -114,105 +129,197 @@ jp_country_map = {
     "中華人民共和国": "PRC"
 }
 
-def translate_jp_country(x):
-    return jp_country_map.get(x, x)
-
 # ================================================================
 # 3. Quarter + Period conversion
 # ================================================================
-def yyyymm_to_qtr(yyyymm):
-    y = int(str(yyyymm)[:4])
-    m = int(str(yyyymm)[4:6])
-    q = (m - 1)//3 + 1
-    return f"{y} Q{q}"
-
-def qtr_to_period(q):
-    y = q.split()[0]
-    if q.endswith("Q1") or q.endswith("Q2"):
-        return f"{y} H1"
-    return f"{y} H2"
+def yyyymm_to_qtr_period(yyyymm):
+    """
+    Vectorized YYYYMM → ("YYYY Qn", "YYYY H1/H2") on integer arrays
+    """
+    ym = yyyymm.astype(np.int32).to_numpy()
+    year = (ym // 100).astype(str)
+    q = (ym % 100 - 1) // 3 + 1
+
+    qtr = np.char.add(np.char.add(year, " Q"), q.astype(str))
+    period = np.char.add(year, np.where(q <= 2, " H1", " H2"))
+    return qtr, period
 
 # ================================================================
-# 4. Load combined dataset
+# 4. Final output columns (mirror TW exactly)
 # ================================================================
-print(f"📂 Loading combined JP trade data from: {INPUT_FILE}")
-df = pd.read_csv(INPUT_FILE, dtype=str)
+FINAL_COLS = [
+    "qtr", "period", "country", "hs10",
+    "US_Group", "NATO_Class", "MTOW",
+    "Quanity", "K JPY",
+    "is_reexport"
+]
 
-# Convert types
-df["yyyymm"] = df["yyyymm"].astype(str)
-df["NO"] = pd.to_numeric(df["NO"], errors="coerce")
-df["Yen_thousand"] = pd.to_numeric(df["Yen_thousand"], errors="coerce")
+# Low-cardinality key columns → categorical (integer codes for groupby/pivot)
+CATEGORY_COLS = ["qtr", "period", "country", "hs10", "US_Group", "NATO_Class", "MTOW"]
 
-# ================================================================
-# 5. Extract country (JP → English)
-# ================================================================
-df["country_jp"] = df["area_name"].apply(lambda x: x.split("_",1)[1])
-df["country"] = df["country_jp"].apply(translate_jp_country)
+PLOT_CATEGORIES = ("hs10", "US_Group", "NATO_Class")
 
-# ================================================================
-# 6. Period variables
-# ================================================================
-df["qtr"] = df["yyyymm"].apply(yyyymm_to_qtr)
-df["period"] = df["qtr"].apply(qtr_to_period)
+# Raw CSV input columns that need a fixed type (everything else is inferred)
+RAW_TYPES = {
+    "flow": pa.string(),
+    "yyyymm": pa.string(),
+    "area_name": pa.string(),
+    "hs10": pa.string(),
+    "NO": pa.float64(),
+    "Yen_thousand": pa.float64(),
+}
 
-# ================================================================
-# 7. HS10 classifications
-# ================================================================
-df[["US_Group", "NATO_Class", "MTOW"]] = df["hs10"].apply(
-    lambda x: pd.Series(map_hs10_to_tuple(x))
-)
+# Fixed schema for the cleaned Parquet files, so every chunk appends to the
+# same writer (categorical keys → dictionary-encoded strings)
+CLEAN_SCHEMA = pa.schema([
+    (c, pa.dictionary(pa.int32(), pa.string()) if c in CATEGORY_COLS
+        else pa.bool_() if c == "is_reexport"
+        else pa.float64())
+    for c in FINAL_COLS
+])
 
-# Japan has no re-export flag
-df["is_reexport"] = False
+# Raw CSV bytes parsed per chunk; peak memory scales with this, not the file
+CHUNK_BYTES = 64 << 20
 
-# Mirror TW naming style
-df["Quanity"] = df["NO"]
-df["K JPY"] = df["Yen_thousand"]
+# Rows per chunk when reading Parquet or an in-memory table
+CHUNK_ROWS = 1 << 20
 
-# ================================================================
-# 8. Select final output columns (mirror TW exactly)
-# ================================================================
-final_cols = [
-    "qtr", "period", "country", "hs10",
-    "US_Group", "NATO_Class", "MTOW",
-    "Quanity", "K JPY",
-    "is_reexport"
-]
+def read_chunks(table=None):
+    """
+    Stream the combined EXPORT + IMPORT data as pandas chunks
+    (Arrow-backed string columns): from an Arrow table already in memory,
+    the Parquet file, or its CSV copy. Dictionary columns are decoded to
+    plain strings so every source yields the same dtypes.
+    """
+    if table is not None:
+        reader = table.to_batches(max_chunksize=CHUNK_ROWS)
+    elif INPUT_FILE.exists():
+        reader = pq.ParquetFile(INPUT_FILE).iter_batches(batch_size=CHUNK_ROWS)
+    else:
+        reader = pa_csv.open_csv(
+            INPUT_CSV,
+            read_options=pa_csv.ReadOptions(block_size=CHUNK_BYTES),
+            convert_options=pa_csv.ConvertOptions(column_types=RAW_TYPES),
+        )
+    to_string = {pa.string(): pd.StringDtype("pyarrow")}.get
+    for batch in reader:
+        batch = batch.cast(pa.schema([
+            f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f
+            for f in batch.schema
+        ]))
+        yield batch.to_pandas(types_mapper=to_string)
 
-# ================================================================
-# 9. Split EXPORT + IMPORT
-# ================================================================
-df_export = df[df["flow"] == "EXPORT"][final_cols].copy()
-df_import = df[df["flow"] == "IMPORT"][final_cols].copy()
+def clean_chunk(df):
+    """
+    Clean one raw chunk and return "flow" + FINAL_COLS
+    """
+    # ================================================================
+    # 6. Extract country (JP → English)
+    # ================================================================
+    df["country_jp"] = df["area_name"].str.partition("_")[2]
+    df["country"] = df["country_jp"].map(jp_country_map).fillna(df["country_jp"])
 
-print(f"EXPORT rows: {len(df_export)}")
-print(f"IMPORT rows: {len(df_import)}")
+    # ================================================================
+    # 7. Period variables
+    # ================================================================
+    df["qtr"], df["period"] = yyyymm_to_qtr_period(df["yyyymm"])
 
-# ================================================================
-# 10. Save cleaned files
-# ================================================================
-df_export.to_csv(OUT_EXPORT, index=False, encoding=ENC)
-df_import.to_csv(OUT_IMPORT, index=False, encoding=ENC)
+    # ================================================================
+    # 8. HS10 classifications
+    # ================================================================
+    df["US_Group"] = df["hs10"].map(HS10_GROUP)
+    df["NATO_Class"] = df["hs10"].map(HS10_CLASS)
+    df["MTOW"] = df["hs10"].map(HS10_MTOW)
 
-print(f"💾 Saved: {OUT_EXPORT}")
-print(f"💾 Saved: {OUT_IMPORT}")
+    # Japan has no re-export flag
+    df["is_reexport"] = False
 
-# ================================================================
-# 11. Run JP plot scripts (TW-style subprocess)
-# ================================================================
-def run_plot(script, flow):
-    cmd = ["python", str(BASE_DIR / script), flow]
-    print("▶ Running:", " ".join(cmd))
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    print(r.stdout)
-    print(r.stderr)
-
-print("\n===== GENERATING EXPORT PLOTS =====")
-run_plot("jp_plot_01_to_02.py", "EXPORT")
-run_plot("jp_plot_03_to_06.py", "EXPORT")
-
-print("\n===== GENERATING IMPORT PLOTS =====")
-run_plot("jp_plot_01_to_02.py", "IMPORT")
-run_plot("jp_plot_03_to_06.py", "IMPORT")
-
-print("\n🎉 ALL JP PLOTS COMPLETED SUCCESSFULLY")
+    # Mirror TW naming style
+    df["Quanity"] = df["NO"]
+    df["K JPY"] = df["Yen_thousand"]
+
+    for c in CATEGORY_COLS:
+        df[c] = df[c].astype("category")
+
+    return df[["flow"] + FINAL_COLS]
+
+def clean(table=None):
+    """
+    Clean the combined file (or the in-memory Arrow table handed over by
+    the download pipeline) chunk by chunk and append each flow's rows to
+    its own Parquet file; the full table is never held in memory.
+    Returns {flow: output path}.
+    """
+    # ================================================================
+    # 5. Load combined dataset (streamed)
+    # ================================================================
+    if table is None:
+        src = INPUT_FILE if INPUT_FILE.exists() else INPUT_CSV
+        print(f"📂 Loading combined JP trade data from: {src}")
+    else:
+        print(f"📂 Using combined JP trade data in memory ({table.num_rows} rows)")
+
+    # ================================================================
+    # 9. Split EXPORT + IMPORT and save cleaned files
+    # ================================================================
+    outputs, writers, rows = {}, {}, {}
+
+    def open_writer(flow):
+        outputs[flow] = BASE_DIR / OUT_CLEAN.format(flow=flow.lower())
+        writers[flow] = pq.ParquetWriter(outputs[flow], CLEAN_SCHEMA, compression="zstd")
+        rows[flow] = 0
+
+    try:
+        # Every plotted flow gets a fresh file, even with no rows, so no
+        # stale cleaned file from an earlier run is ever picked up
+        for flow in jp_plot_common.FLOWS:
+            open_writer(flow)
+
+        for chunk in read_chunks(table):
+            for flow, sub in clean_chunk(chunk).groupby("flow", sort=False, observed=True):
+                if flow not in writers:
+                    open_writer(flow)
+                out_table = pa.Table.from_pandas(sub[FINAL_COLS], schema=CLEAN_SCHEMA,
+                                                 preserve_index=False)
+                writers[flow].write_table(out_table)
+                rows[flow] += len(sub)
+    finally:
+        for w in writers.values():
+            w.close()
+
+    for flow, out in outputs.items():
+        print(f"{flow} rows: {rows[flow]}")
+        print(f"💾 Saved: {out}")
+
+        if WRITE_CSV:
+            pd.read_parquet(out).to_csv(out.with_suffix(".csv"), index=False, encoding=ENC)
+            print(f"💾 Saved: {out.with_suffix('.csv')}")
+
+    return outputs
+
+def main(table=None):
+    """
+    Clean + plot. table: the combined data as an Arrow table (as written to
+    INPUT_FILE), to skip re-reading it from disk
+    """
+    clean(table)
+
+    # ================================================================
+    # 10. Run JP plots in-process (each flow's cleaned file is loaded
+    #     once by jp_plot_common and shared by all plot modules)
+    # ================================================================
+    for flow in jp_plot_common.FLOWS:
+        print(f"\n===== GENERATING {flow} PLOTS =====")
+        for category_col in PLOT_CATEGORIES:
+            jp_plot_01_to_02.run_plot_01_02(category_col, flow)
+        for category_col in PLOT_CATEGORIES:
+            jp_plot_03_to_06.run_plot_03_04(category_col, flow)
+        for category_col in PLOT_CATEGORIES:
+            jp_plot_03_to_06.run_plot_05_06(category_col, flow)
+
+    print("\n🎉 ALL JP PLOTS COMPLETED SUCCESSFULLY")
+
+
+# Guarded so plot worker processes can import this module safely
+if __name__ == "__main__":
+    main()
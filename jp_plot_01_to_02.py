@@ -7,97 +7,42 @@ Updated to match combined IMPORT + EXPORT pipeline.
 
 This script:
  - Accepts flow argument: "EXPORT" or "IMPORT"
+   (or import it and call run_plot_01_02(category_col, flow) directly)
  - Loads:
-       JP_cleaned_export_by_hs10.csv
+       JP_cleaned_export_by_hs10.parquet
        or
-       JP_cleaned_import_by_hs10.csv
+       JP_cleaned_import_by_hs10.parquet
+   (via jp_plot_common; falls back to the .csv copy if no Parquet file exists)
  - Outputs PNGs under /plot/ with JP_EXPORT_ or JP_IMPORT_ prefixes
 """
 
 import sys
-import matplotlib.pyplot as plt
-import pandas as pd
-import re
-from pathlib import Path
-import calendar as _cal
-
-# ================================================================
-# 0. Validate flow argument (EXPORT or IMPORT)
-# ================================================================
-if len(sys.argv) < 2:
-    print("❌ Missing flow argument. Use: python jp_plot_01_to_02.py EXPORT")
-    sys.exit(1)
+import numpy as np
 
-FLOW = sys.argv[1].upper()
-if FLOW not in ("EXPORT", "IMPORT"):
-    print("❌ Invalid flow argument. Use EXPORT or IMPORT.")
-    sys.exit(1)
-
-# Prefix for output files
-PREFIX = f"JP_{FLOW}"
-
-# ================================================================
-# 1. Directories
-# ================================================================
-DATA_DIR = Path(
-    "~/Library/Mobile Documents/com~apple~CloudDocs/github/drone-export-jp"
-).expanduser()
-
-EXPORT_DIR = DATA_DIR / "plot"
-EXPORT_DIR.mkdir(parents=True, exist_ok=True)
-
-# Load respective dataset
-CLEAN_FILE = DATA_DIR / f"JP_cleaned_{FLOW.lower()}_by_hs10.csv"
-
-print(f"📂 Loading dataset: {CLEAN_FILE}")
-df = pd.read_csv(CLEAN_FILE)
-
-# ================================================================
-# 2. Country Colors
-# ================================================================
-cmap = plt.get_cmap("tab20")
-all_countries = sorted(df["country"].dropna().unique())
-country_color_map = {c: cmap(i % cmap.N) for i, c in enumerate(all_countries)}
+# jp_plot_common selects the Agg backend, so it is imported before pyplot
+from jp_plot_common import (
+    FLOWS, SUBSETS, AGG_KEYS, aggregate, hs10_mtow, visible_columns, plot_job, render_all,
+    sort_pivot_index, order_by_total, row_pct,
+)
 
-# ================================================================
-# 3. Quarter Sort Logic (identical to TW)
-# ================================================================
-def _qtr_sort_key(lbl: str):
-    # YYYY Qn
-    m = re.match(r"(\d{4})\s+Q([1-4])$", lbl)
-    if m:
-        return (int(m.group(1)), int(m.group(2)), 0)
-
-    # Running month range
-    m = re.match(r"(\d{4})\s+([A-Za-z]{3})(?:/([A-Za-z]{3})(?:/([A-Za-z]{3}))?)?$", lbl)
-    if m:
-        year = int(m.group(1))
-        mon = list(_cal.month_abbr).index(m.group(2).capitalize())
-        q = (mon - 1) // 3 + 1
-        return (year, q, 1)
-
-    return (0, 0, 0)
-
-def _sort_pivot_index(pivot: pd.DataFrame):
-    order = sorted(pivot.index.tolist(), key=_qtr_sort_key)
-    return pivot.reindex(order)
+import matplotlib.pyplot as plt
 
 # ================================================================
-# 4. Generic stacked bar plot
+# 1. Generic stacked bar plot
 # ================================================================
-def stacked_plot(pivot, title, ylabel, filename, fmt="{val}", label_thresh=10):
-    fig, ax = plt.subplots(figsize=(12, 6))
-
-    col_totals = pivot.sum(axis=0)
-    all_below = (col_totals <= label_thresh).all()
-
-    visible = [
-        c for c in pivot.columns
-        if (col_totals[c] > label_thresh or all_below) and col_totals[c] > 0
-    ]
-
-    pivot = pivot[visible]
-    colors = [country_color_map.get(c, "#CCCCCC") for c in pivot.columns]
+# One figure for every plot: cleared and redrawn instead of re-created.
+# Fixed margins leave room for the outside legend without tight_layout.
+FIG, AX = plt.subplots(figsize=(12, 6))
+FIG.set_dpi(300)
+FIG.subplots_adjust(right=0.78, bottom=0.2)
+
+def stacked_plot(pivot, colors, title, ylabel, outpath, fmt="{val}", label_thresh=10):
+    """
+    Plot 01/02 renderer: draws a plot_job tuple on the shared figure with
+    its fixed margins and writes the PNG straight from the canvas
+    """
+    fig, ax = FIG, AX
+    ax.clear()
 
     pivot.plot(kind="bar", stacked=True, ax=ax, color=colors)
 
@@ -105,108 +50,128 @@ def stacked_plot(pivot, title, ylabel, filename, fmt="{val}", label_thresh=10):
     max_val = pivot.values.max()
     show_all = max_val <= label_thresh
 
-    for i, (idx, row) in enumerate(pivot.iterrows()):
-        cumulative = 0
-        for j, val in enumerate(row):
-            if val == 0:
-                continue
-            if show_all or val > label_thresh:
-                ax.text(i, cumulative + val/2, fmt.format(val=val),
-                        ha="center", va="center", fontsize=8)
-            cumulative += val
+    # Segment midpoints and label mask computed on the whole array at once
+    arr = pivot.to_numpy(dtype=float)
+    mid = arr.cumsum(axis=1) - arr / 2
+    mask = (arr != 0) & (show_all | (arr > label_thresh))
+
+    for i, j in zip(*np.nonzero(mask)):
+        ax.text(i, mid[i, j], fmt.format(val=arr[i, j]),
+                ha="center", va="center", fontsize=8)
 
     ax.set_title(title)
     ax.set_ylabel(ylabel)
     ax.set_xlabel("Quarter/Month")
 
-    if visible:
-        ax.legend(title="Country", bbox_to_anchor=(1.05, 1), loc="upper left")
-    else:
-        ax.legend().set_visible(False)
+    ax.legend(title="Country", bbox_to_anchor=(1.05, 1), loc="upper left")
 
-    plt.tight_layout()
-    fig.savefig(EXPORT_DIR / filename, dpi=300)
-    plt.close(fig)
+    fig.canvas.print_png(outpath)
 
 # ================================================================
-# 5. Main function
+# 2. Main function
 # ================================================================
-def run_plot_01_02(category_col):
-    if category_col not in df.columns:
+def run_plot_01_02(category_col, flow):
+    flow = flow.upper()
+    prefix = f"JP_{flow}"
+
+    if category_col not in AGG_KEYS:
         print(f"❌ Column not found: {category_col}")
         return
 
-    subsets = {
-        "All": df,
-        "Exclude_re-export": df[~df["is_reexport"]]
-    }
+    mtow_labels = hs10_mtow(flow)
+    jobs = []
 
-    for suffix, subset in subsets.items():
+    for suffix in SUBSETS:
+        agg = aggregate(flow, suffix, "Quanity")
 
         # ====================================================
         # 01 — Total Counts
         # ====================================================
-        total = subset.groupby(["qtr", "country"])["Quanity"].sum().reset_index()
-        pivot_total = total.pivot(index="qtr", columns="country", values="Quanity").fillna(0)
+        pivot_total = (
+            agg.groupby(level=["qtr", "country"], observed=True)
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        pivot_total = pivot_total[pivot_total.sum().sort_values(ascending=False).index]
-        pivot_total = _sort_pivot_index(pivot_total)
+        # Column totals computed once: used for the column order and the
+        # visible-country filter of the counts plot
+        pivot_total, col_totals = order_by_total(pivot_total)
+        pivot_total = sort_pivot_index(pivot_total)
+        visible_total = visible_columns(col_totals, 10)
 
-        f1 = f"{PREFIX}_01_Counts_total_{suffix}.png"
-        t1 = f"{FLOW} – Total by Country ({suffix})"
+        f1 = f"{prefix}_01_Counts_total_{suffix}.png"
+        t1 = f"{flow} – Total by Country ({suffix})"
 
-        stacked_plot(pivot_total, t1, "Quantity", f1, "{val:.0f}", 10)
+        jobs.append(plot_job(pivot_total, flow, t1, "Quantity", f1, "{val:.0f}", 10,
+                             visible_total))
 
         # ====================================================
         # 02 — Percent Share
         # ====================================================
-        percent_total = pivot_total.div(pivot_total.sum(axis=1), axis=0) * 100
+        percent_total = row_pct(pivot_total)
 
-        f2 = f"{PREFIX}_02_Percent_total_{suffix}.png"
-        t2 = f"{FLOW} – Country Share ({suffix})"
+        f2 = f"{prefix}_02_Percent_total_{suffix}.png"
+        t2 = f"{flow} – Country Share ({suffix})"
 
-        stacked_plot(percent_total, t2, "Share (%)", f2, "{val:.1f}%", 1.5)
+        jobs.append(plot_job(percent_total, flow, t2, "Share (%)", f2, "{val:.1f}%", 1.5))
 
         # ====================================================
         # Per Category (HS10, US_Group, NATO_Class)
         # ====================================================
-        grouped = subset.groupby(["qtr", category_col, "country"])["Quanity"].sum().reset_index()
+        # Wide (category, qtr) × country table, walked group by group
+        grouped = (
+            agg.groupby(level=[category_col, "qtr", "country"], observed=True)
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        for cat_val in grouped[category_col].dropna().unique():
-            cat_df = grouped[grouped[category_col] == cat_val]
-            pivot = cat_df.pivot(index="qtr", columns="country", values="Quanity").fillna(0)
+        for cat_val, pivot in grouped.groupby(level=category_col, observed=True, sort=False):
+            pivot = pivot.droplevel(category_col)
 
-            pivot = pivot[pivot.sum().sort_values(ascending=False).index]
-            pivot = _sort_pivot_index(pivot)
+            pivot, col_totals = order_by_total(pivot)
+            pivot = sort_pivot_index(pivot)
+            visible = visible_columns(col_totals, 10)
 
             clean_name = str(cat_val).replace(" ", "_").replace("/", "_").replace(".", "")
 
-            f3 = f"{PREFIX}_01_Counts_{category_col}_{suffix}_{clean_name}.png"
-            f4 = f"{PREFIX}_02_Percent_{category_col}_{suffix}_{clean_name}.png"
+            f3 = f"{prefix}_01_Counts_{category_col}_{suffix}_{clean_name}.png"
+            f4 = f"{prefix}_02_Percent_{category_col}_{suffix}_{clean_name}.png"
 
-            title1 = f"{FLOW} – {category_col}: {cat_val} ({suffix})"
-            title2 = f"{FLOW} Share – {category_col}: {cat_val} ({suffix})"
+            title1 = f"{flow} – {category_col}: {cat_val} ({suffix})"
+            title2 = f"{flow} Share – {category_col}: {cat_val} ({suffix})"
 
             # Add MTOW annotation if HS10
             if category_col == "hs10":
-                mtow = df[df["hs10"] == cat_val]["MTOW"].dropna().unique()
-                if len(mtow) == 1:
-                    title1 += f" (MTOW: {mtow[0]})"
-                    title2 += f" (MTOW: {mtow[0]})"
+                mtow = mtow_labels.get(cat_val)
+                if mtow is not None:
+                    title1 += f" (MTOW: {mtow})"
+                    title2 += f" (MTOW: {mtow})"
+
+            jobs.append(plot_job(pivot, flow, title1, "Quantity", f3, "{val:.0f}", 10,
+                                 visible))
 
-            stacked_plot(pivot, title1, "Quantity", f3, "{val:.0f}", 10)
+            percent = row_pct(pivot)
 
-            percent = pivot.div(pivot.sum(axis=1), axis=0) * 100
+            jobs.append(plot_job(percent, flow, title2, "Share (%)", f4, "{val:.1f}%", 1.5))
 
-            stacked_plot(percent, title2, "Share (%)", f4, "{val:.1f}%", 1.5)
+    # Independent PNGs: render across all cores (shared pool)
+    render_all(stacked_plot, jobs)
 
-    print(f"✅ Finished JP plot_01_02 for {category_col} ({FLOW})")
+    print(f"✅ Finished JP plot_01_02 for {category_col} ({flow})")
 
 
-# If called directly by subprocess
+# If called directly (standalone / TW-style subprocess)
 if __name__ == "__main__":
-    # These three match TW version
-    run_plot_01_02("hs10")
-    run_plot_01_02("US_Group")
-    run_plot_01_02("NATO_Class")
+    if len(sys.argv) < 2:
+        print("❌ Missing flow argument. Use: python jp_plot_01_to_02.py EXPORT")
+        sys.exit(1)
+
+    FLOW = sys.argv[1].upper()
+    if FLOW not in FLOWS:
+        print("❌ Invalid flow argument. Use EXPORT or IMPORT.")
+        sys.exit(1)
 
+    # These three match TW version
+    run_plot_01_02("hs10", FLOW)
+    run_plot_01_02("US_Group", FLOW)
+    run_plot_01_02("NATO_Class", FLOW)
@@ -8,291 +8,252 @@ Updated for combined IMPORT + EXPORT pipeline.
 Usage:
     python jp_plot_03_to_06.py EXPORT
     python jp_plot_03_to_06.py IMPORT
+
+or import it and call run_plot_03_04(category_col, flow) /
+run_plot_05_06(category_col, flow) directly.
 """
 
 import sys
-import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
-import re
-from pathlib import Path
-import calendar as _cal
-
-# ================================================================
-# 0. FLOW ARGUMENT (EXPORT / IMPORT)
-# ================================================================
-if len(sys.argv) < 2:
-    print("❌ Missing flow argument. Use: python jp_plot_03_to_06.py EXPORT")
-    sys.exit(1)
-
-FLOW = sys.argv[1].upper()
-if FLOW not in ("EXPORT", "IMPORT"):
-    print("❌ Invalid argument. Use EXPORT or IMPORT.")
-    sys.exit(1)
-
-PREFIX = f"JP_{FLOW}"
-
-# ================================================================
-# 1. Directories
-# ================================================================
-DATA_DIR = Path(
-    "~/Library/Mobile Documents/com~apple~CloudDocs/github/drone-export-jp"
-).expanduser()
-
-EXPORT_DIR = DATA_DIR / "plot"
-EXPORT_DIR.mkdir(parents=True, exist_ok=True)
-
-# Load correct dataset
-CLEAN_FILE = DATA_DIR / f"JP_cleaned_{FLOW.lower()}_by_hs10.csv"
-print(f"📂 Loading dataset: {CLEAN_FILE}")
 
-df = pd.read_csv(CLEAN_FILE)
+# jp_plot_common selects the Agg backend, so it is imported before pyplot
+from jp_plot_common import (
+    FLOWS, SUBSETS, AGG_KEYS, load_clean, load_subset, aggregate, hs10_mtow,
+    plot_job, render_all, sort_pivot_index, order_by_total, row_pct,
+)
 
-# ================================================================
-# 2. Country Color Map
-# ================================================================
-cmap = plt.get_cmap("tab20")
-all_countries = sorted(df["country"].dropna().unique())
-country_color_map = {c: cmap(i % cmap.N) for i, c in enumerate(all_countries)}
+import matplotlib.pyplot as plt
 
 # ================================================================
-# 3. Quarter Sorting (TW logic)
+# 1. Filename cleaner
 # ================================================================
-def _qtr_sort_key(lbl: str):
-    # YYYY Qn
-    m = re.match(r"(\d{4})\s+Q([1-4])$", lbl)
-    if m:
-        return (int(m.group(1)), int(m.group(2)), 0)
-
-    # Running quarterly: YYYY Jan/Feb/Mar
-    m = re.match(r"(\d{4})\s+([A-Za-z]{3})(?:/([A-Za-z]{3})"
-                 r"(?:/([A-Za-z]{3}))?)?$", lbl)
-    if m:
-        year = int(m.group(1))
-        mon = list(_cal.month_abbr).index(m.group(2).capitalize())
-        q = (mon - 1) // 3 + 1
-        return (year, q, 1)
-
-    return (0, 0, 0)
-
-def _sort_pivot_index(pivot):
-    order = sorted(pivot.index.tolist(), key=_qtr_sort_key)
-    return pivot.reindex(order)
+# Separators → "_", dots and characters invalid in filenames dropped
+_FN_TABLE = str.maketrans({" ": "_", "/": "_", ":": "_",
+                           **dict.fromkeys(".<>\"|?*")})
 
-# ================================================================
-# 4. Filename cleaner
-# ================================================================
 def _clean_val_for_filename(v):
-    s = str(v).strip()
-    s = s.replace(" ", "_").replace("/", "_").replace(":", "_")
-    s = s.replace(".", "")
-    s = "".join(ch for ch in s if ch not in "<>\"|?*")
-    return s or "Unknown"
+    return str(v).strip().translate(_FN_TABLE) or "Unknown"
 
 # ================================================================
-# 5. Stacked Plot Helper
+# 2. Stacked Plot Helper
 # ================================================================
-def _stacked_plot(pivot, title, ylabel, filename, fmt="{val}", label_thresh=10):
-    fig, ax = plt.subplots(figsize=(12, 6))
-
-    col_totals = pivot.sum(axis=0)
-    all_below = (col_totals <= label_thresh).all()
+# One figure per process: cleared and redrawn for every plot. Margins are
+# reset before each tight_layout so it never starts from the previous plot's.
+FIG, AX = plt.subplots(figsize=(12, 6))
+_DEFAULT_MARGINS = {k: getattr(FIG.subplotpars, k) for k in ("left", "right", "bottom", "top")}
+
+def _stacked_plot(pivot, colors, title, ylabel, outpath, fmt="{val}", label_thresh=10):
+    """
+    Plot 03-06 renderer: draws a plot_job tuple on the shared figure,
+    tight_layout from the default margins, saved at 300 dpi
+    """
+    fig, ax = FIG, AX
+    ax.clear()
+    fig.subplots_adjust(**_DEFAULT_MARGINS)
 
-    visible = [
-        c for c in pivot.columns
-        if (col_totals[c] > label_thresh or all_below) and col_totals[c] > 0
-    ]
-
-    pivot = pivot[visible]
-    colors = [country_color_map.get(c, "#CCCCCC") for c in pivot.columns]
     pivot.plot(kind="bar", stacked=True, ax=ax, color=colors)
 
     max_val = pivot.values.max()
     show_all = max_val <= label_thresh
 
-    # Label each bar segment
-    for i, (idx, row) in enumerate(pivot.iterrows()):
-        cumulative = 0
-        for j, val in enumerate(row):
-            if val == 0:
-                continue
-            if show_all or val > label_thresh:
-                ax.text(i, cumulative + val/2,
-                        fmt.format(val=val),
-                        ha="center", va="center", fontsize=8)
-            cumulative += val
+    # Label each bar segment: midpoints and label mask on the whole array
+    arr = pivot.to_numpy(dtype=float)
+    mid = arr.cumsum(axis=1) - arr / 2
+    mask = (arr != 0) & (show_all | (arr > label_thresh))
+
+    for i, j in zip(*np.nonzero(mask)):
+        ax.text(i, mid[i, j], fmt.format(val=arr[i, j]),
+                ha="center", va="center", fontsize=8)
 
     ax.set_title(title)
     ax.set_ylabel(ylabel)
     ax.set_xlabel("Quarter / Period")
 
-    if visible:
-        ax.legend(title="Country", bbox_to_anchor=(1.05, 1), loc="upper left")
-    else:
-        ax.legend().set_visible(False)
+    ax.legend(title="Country", bbox_to_anchor=(1.05, 1), loc="upper left")
 
-    plt.tight_layout()
-    fig.savefig(EXPORT_DIR / filename, dpi=300)
-    plt.close(fig)
-    return filename
+    fig.tight_layout()
+    fig.savefig(outpath, dpi=300)
+    return outpath
 
 # ================================================================
-# 6. Plot 03 & 04 (Value by Quarter)
+# 3. Plot 03 & 04 (Value by Quarter)
 # ================================================================
-def run_plot_03_04(category_col):
-    if category_col not in df.columns:
+def run_plot_03_04(category_col, flow):
+    flow = flow.upper()
+    prefix = f"JP_{flow}"
+    if category_col not in AGG_KEYS:
         print(f"❌ Column not found: {category_col}")
         return
 
-    subsets = {
-        "All": df,
-        "Exclude_re-export": df[~df["is_reexport"]]
-    }
-
-    for suffix, subset in subsets.items():
+    mtow_labels = hs10_mtow(flow)
+    jobs = []
+    for suffix in SUBSETS:
+        agg = aggregate(flow, suffix, "K JPY")
 
         # --------------------- Plot 03: TOTAL VALUE ---------------------
-        total_val = subset.groupby(["qtr", "country"])["K JPY"].sum().reset_index()
-        pivot_val = total_val.pivot(index="qtr", columns="country", values="K JPY").fillna(0)
+        pivot_val = (
+            agg.groupby(level=["qtr", "country"], observed=True)
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        pivot_val = pivot_val[pivot_val.sum().sort_values(ascending=False).index]
-        pivot_val = _sort_pivot_index(pivot_val)
+        pivot_val, _ = order_by_total(pivot_val)
+        pivot_val = sort_pivot_index(pivot_val)
 
-        f03 = f"{PREFIX}_03_Value_{suffix}.png"
-        t03 = f"{FLOW} Value by Country – {suffix}"
+        f03 = f"{prefix}_03_Value_{suffix}.png"
+        t03 = f"{flow} Value by Country – {suffix}"
 
-        _stacked_plot(
-            pivot_val, t03, "Value (K JPY)",
+        jobs.append(plot_job(
+            pivot_val, flow, t03, "Value (K JPY)",
             f03, fmt="{val:.0f}", label_thresh=1000
-        )
+        ))
 
         # --------------------- Plot 04: PERCENT VALUE SHARE ---------------------
-        pct_val = pivot_val.div(pivot_val.sum(axis=1), axis=0) * 100
+        pct_val = row_pct(pivot_val)
 
-        f04 = f"{PREFIX}_04_ValuePct_{suffix}.png"
-        t04 = f"{FLOW} Value Share – {suffix}"
+        f04 = f"{prefix}_04_ValuePct_{suffix}.png"
+        t04 = f"{flow} Value Share – {suffix}"
 
-        _stacked_plot(
-            pct_val, t04, "Percentage Value (%)",
+        jobs.append(plot_job(
+            pct_val, flow, t04, "Percentage Value (%)",
             f04, fmt="{val:.1f}%", label_thresh=2
-        )
+        ))
 
         # --------------------- Per Category ---------------------
-        grouped = subset.groupby(["qtr", category_col, "country"])["K JPY"].sum().reset_index()
+        # Wide (category, qtr) × country table, walked group by group
+        grouped = (
+            agg.groupby(level=[category_col, "qtr", "country"], observed=True)
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        for cat_val in grouped[category_col].dropna().unique():
-            cat_df = grouped[grouped[category_col] == cat_val]
-            pivot = cat_df.pivot(index="qtr", columns="country", values="K JPY").fillna(0)
+        for cat_val, pivot in grouped.groupby(level=category_col, observed=True, sort=False):
+            pivot = pivot.droplevel(category_col)
 
-            pivot = pivot[pivot.sum().sort_values(ascending=False).index]
-            pivot = _sort_pivot_index(pivot)
+            pivot, _ = order_by_total(pivot)
+            pivot = sort_pivot_index(pivot)
 
             clean_val = _clean_val_for_filename(cat_val)
 
-            f03c = f"{PREFIX}_03_Value_{category_col}_{suffix}_{clean_val}.png"
-            f04c = f"{PREFIX}_04_ValuePct_{category_col}_{suffix}_{clean_val}.png"
+            f03c = f"{prefix}_03_Value_{category_col}_{suffix}_{clean_val}.png"
+            f04c = f"{prefix}_04_ValuePct_{category_col}_{suffix}_{clean_val}.png"
 
-            title03 = f"{FLOW} Value for {cat_val} – {suffix}"
-            title04 = f"{FLOW} Value Share for {cat_val} – {suffix}"
+            title03 = f"{flow} Value for {cat_val} – {suffix}"
+            title04 = f"{flow} Value Share for {cat_val} – {suffix}"
 
             # Add MTOW annotation
             if category_col == "hs10":
-                mtow = df[df["hs10"] == cat_val]["MTOW"].dropna().unique()
-                if len(mtow) == 1:
-                    title03 += f" (MTOW: {mtow[0]})"
-                    title04 += f" (MTOW: {mtow[0]})"
+                mtow = mtow_labels.get(cat_val)
+                if mtow is not None:
+                    title03 += f" (MTOW: {mtow})"
+                    title04 += f" (MTOW: {mtow})"
 
-            _stacked_plot(
-                pivot, title03, "Value (K JPY)",
+            jobs.append(plot_job(
+                pivot, flow, title03, "Value (K JPY)",
                 f03c, fmt="{val:.0f}", label_thresh=1000
-            )
+            ))
 
-            pct = pivot.div(pivot.sum(axis=1), axis=0) * 100
+            pct = row_pct(pivot)
 
-            _stacked_plot(
-                pct, title04, "Percentage Value (%)",
+            jobs.append(plot_job(
+                pct, flow, title04, "Percentage Value (%)",
                 f04c, fmt="{val:.1f}%", label_thresh=2
-            )
+            ))
 
-    print(f"✅ Finished JP plot_03_04 for {category_col} ({FLOW})")
+    render_all(_stacked_plot, jobs)
+    print(f"✅ Finished JP plot_03_04 for {category_col} ({flow})")
 
 # ================================================================
-# 7. Plot 05 & 06 (Period-based Units + Value)
+# 4. Plot 05 & 06 (Period-based Units + Value)
 # ================================================================
-def run_plot_05_06(category_col):
+def run_plot_05_06(category_col, flow):
+    flow = flow.upper()
+    prefix = f"JP_{flow}"
+    df = load_clean(flow)
+
     if category_col not in df.columns:
         print(f"❌ Column not found: {category_col}")
         return
 
-    subsets = {
-        "All": df,
-        "Exclude_re-export": df[~df["is_reexport"]]
-    }
-
-    for suffix, subset in subsets.items():
+    jobs = []
+    for suffix in SUBSETS:
+        subset = load_subset(flow, suffix)
 
         # ------------------------------ PERIOD UNITS ------------------------------
-        total_units = subset.groupby(["period", "country"])["Quanity"].sum().reset_index()
-        p_units = total_units.pivot(index="period", columns="country",
-                                    values="Quanity").fillna(0)
+        p_units = (
+            subset.groupby(["period", "country"], observed=True)["Quanity"]
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        p_units = p_units[p_units.sum().sort_values(ascending=False).index]
+        p_units, _ = order_by_total(p_units)
 
-        f05 = f"{PREFIX}_05_Units_{suffix}.png"
-        t05 = f"{FLOW} Units by Period – {suffix}"
+        f05 = f"{prefix}_05_Units_{suffix}.png"
+        t05 = f"{flow} Units by Period – {suffix}"
 
-        _stacked_plot(
-            p_units, t05, "Units (NO)",
+        jobs.append(plot_job(
+            p_units, flow, t05, "Units (NO)",
             f05, fmt="{val:.0f}", label_thresh=10
-        )
+        ))
 
         # ------------------------------ PERIOD VALUE ------------------------------
-        total_val = subset.groupby(["period", "country"])["K JPY"].sum().reset_index()
-        p_val = total_val.pivot(index="period", columns="country",
-                                values="K JPY").fillna(0)
+        p_val = (
+            subset.groupby(["period", "country"], observed=True)["K JPY"]
+            .sum()
+            .unstack("country", fill_value=0)
+        )
 
-        p_val = p_val[p_val.sum().sort_values(ascending=False).index]
+        p_val, _ = order_by_total(p_val)
 
-        f05v = f"{PREFIX}_05_Value_{suffix}.png"
-        t05v = f"{FLOW} Value by Period – {suffix}"
+        f05v = f"{prefix}_05_Value_{suffix}.png"
+        t05v = f"{flow} Value by Period – {suffix}"
 
-        _stacked_plot(
-            p_val, t05v, "Value (K JPY)",
+        jobs.append(plot_job(
+            p_val, flow, t05v, "Value (K JPY)",
             f05v, fmt="{val:.0f}", label_thresh=500
-        )
+        ))
 
         # ------------------------------ PERCENT UNITS ------------------------------
-        pct_units = p_units.div(p_units.sum(axis=1), axis=0) * 100
+        pct_units = row_pct(p_units)
 
-        f06 = f"{PREFIX}_06_UnitsPct_{suffix}.png"
-        t06 = f"{FLOW} Unit Share by Period – {suffix}"
+        f06 = f"{prefix}_06_UnitsPct_{suffix}.png"
+        t06 = f"{flow} Unit Share by Period – {suffix}"
 
-        _stacked_plot(
-            pct_units, t06, "Share (%)",
+        jobs.append(plot_job(
+            pct_units, flow, t06, "Share (%)",
             f06, fmt="{val:.1f}%", label_thresh=2
-        )
+        ))
 
         # ------------------------------ PERCENT VALUE ------------------------------
-        pct_val = p_val.div(p_val.sum(axis=1), axis=0) * 100
+        pct_val = row_pct(p_val)
 
-        f06v = f"{PREFIX}_06_ValuePct_{suffix}.png"
-        t06v = f"{FLOW} Value Share by Period – {suffix}"
+        f06v = f"{prefix}_06_ValuePct_{suffix}.png"
+        t06v = f"{flow} Value Share by Period – {suffix}"
 
-        _stacked_plot(
-            pct_val, t06v, "Share (%)",
+        jobs.append(plot_job(
+            pct_val, flow, t06v, "Share (%)",
             f06v, fmt="{val:.1f}%", label_thresh=2
-        )
+        ))
 
-    print(f"✅ Finished JP plot_05_06 for {category_col} ({FLOW})")
+    render_all(_stacked_plot, jobs)
+    print(f"✅ Finished JP plot_05_06 for {category_col} ({flow})")
 
 
-# If executed directly by subprocess (TW-style)
+# If executed directly (standalone / TW-style subprocess)
 if __name__ == "__main__":
-    run_plot_03_04("hs10")
-    run_plot_03_04("US_Group")
-    run_plot_03_04("NATO_Class")
-
-    run_plot_05_06("hs10")
-    run_plot_05_06("US_Group")
-    run_plot_05_06("NATO_Class")
-
+    if len(sys.argv) < 2:
+        print("❌ Missing flow argument. Use: python jp_plot_03_to_06.py EXPORT")
+        sys.exit(1)
+
+    FLOW = sys.argv[1].upper()
+    if FLOW not in FLOWS:
+        print("❌ Invalid argument. Use EXPORT or IMPORT.")
+        sys.exit(1)
+
+    run_plot_03_04("hs10", FLOW)
+    run_plot_03_04("US_Group", FLOW)
+    run_plot_03_04("NATO_Class", FLOW)
+
+    run_plot_05_06("hs10", FLOW)
+    run_plot_05_06("US_Group", FLOW)
+    run_plot_05_06("NATO_Class", FLOW)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Shared state for the JP plot modules (jp_plot_01_to_02, jp_plot_03_to_06)
+
+ - One place for the data/plot directories
+ - One cleaned dataset per flow, loaded once and reused by every plot module
+ - One country → colour map per flow
+ - Shared aggregates (per measure) and hs10 → MTOW labels
+ - Pivot helpers (quarter ordering, column ordering, percent share)
+ - Plot job packaging and one process pool shared by every plot module
+"""
+
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import calendar as _cal
+import matplotlib
+matplotlib.use("Agg")  # headless backend, set before pyplot is imported
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+FLOWS = ("EXPORT", "IMPORT")
+
+# ================================================================
+# 1. Directories
+# ================================================================
+DATA_DIR = Path(
+    "~/Library/Mobile Documents/com~apple~CloudDocs/github/drone-export-jp"
+).expanduser()
+
+EXPORT_DIR = DATA_DIR / "plot"
+EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+
+# ================================================================
+# 2. Cleaned dataset per flow
+# ================================================================
+# Columns the plot modules actually read; anything else in the cleaned
+# file is skipped at load time
+CLEAN_COLS = [
+    "qtr", "period", "country", "hs10",
+    "US_Group", "NATO_Class", "MTOW",
+    "Quanity", "K JPY", "is_reexport",
+]
+
+# Low-cardinality key columns, loaded as categoricals
+CATEGORY_COLS = ["qtr", "period", "country", "US_Group", "NATO_Class", "MTOW", "hs10"]
+
+# Measures stay float64: period totals in K JPY can exceed float32's exact
+# integer range (2**24) and the bar labels print them to the unit
+VALUE_DTYPES = {"Quanity": "float64", "K JPY": "float64"}
+
+_CLEAN = {}
+
+def load_clean(flow):
+    """
+    Cleaned dataset for one flow, loaded once per process
+    (Parquet from the cleaning step, CSV copy as fallback)
+    """
+    flow = flow.upper()
+    if flow in _CLEAN:
+        return _CLEAN[flow]
+
+    clean_file = DATA_DIR / f"JP_cleaned_{flow.lower()}_by_hs10.parquet"
+    if not clean_file.exists():
+        clean_file = clean_file.with_suffix(".csv")
+
+    print(f"📂 Loading dataset: {clean_file}")
+    if clean_file.suffix == ".parquet":
+        df = pd.read_parquet(clean_file, columns=CLEAN_COLS)
+
+        # Chunked writes merge per-chunk dictionaries in first-seen order;
+        # restore sorted categories so groupby/pivot order matches the CSV path
+        for c in df.select_dtypes("category").columns:
+            df[c] = df[c].cat.reorder_categories(sorted(df[c].cat.categories))
+    else:
+        # Arrow's multithreaded CSV reader; categorical keys built during
+        # parsing so groupby hashes integer codes instead of Python strings
+        df = pd.read_csv(
+            clean_file,
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+            usecols=CLEAN_COLS,
+            dtype={
+                **dict.fromkeys(CATEGORY_COLS, "category"),
+                **VALUE_DTYPES,
+                "is_reexport": "bool",
+            },
+        )
+
+    _CLEAN[flow] = df
+    return df
+
+SUBSETS = ("All", "Exclude_re-export")
+
+@lru_cache(maxsize=None)
+def load_subset(flow, suffix):
+    """
+    load_clean(flow), minus re-exports for "Exclude_re-export"; the
+    filtered copy is built once per process and shared by every plot module
+    """
+    df = load_clean(flow)
+    if suffix == "All":
+        return df
+    return df[~df["is_reexport"].to_numpy()]
+
+# Every key any plot slices by; each measure is aggregated once per
+# (flow, subset) and shared by the hs10 / US_Group / NATO_Class runs
+AGG_KEYS = ["qtr", "country", "US_Group", "NATO_Class", "hs10"]
+
+@lru_cache(maxsize=None)
+def aggregate(flow, suffix, measure):
+    """
+    load_subset(flow, suffix) summed over AGG_KEYS for one measure column
+    """
+    subset = load_subset(flow, suffix)
+    return subset.groupby(AGG_KEYS, observed=True, dropna=False)[measure].sum()
+
+@lru_cache(maxsize=None)
+def hs10_mtow(flow):
+    """
+    hs10 → MTOW label for the plot titles (codes with exactly one MTOW)
+    """
+    labels = (
+        load_clean(flow)
+        .dropna(subset=["MTOW"])
+        .groupby("hs10", observed=True)["MTOW"]
+        .unique()
+    )
+    return {hs10: mtow[0] for hs10, mtow in labels.items() if len(mtow) == 1}
+
+# ================================================================
+# 3. Country Colors
+# ================================================================
+@lru_cache(maxsize=None)
+def _color_map(countries):
+    """
+    Country → RGBA for a sorted tuple of countries; all colours are looked
+    up from the colormap in one indexed call
+    """
+    cmap = plt.get_cmap("tab20")
+    colors = cmap(np.arange(len(countries)) % cmap.N)
+    return dict(zip(countries, map(tuple, colors)))
+
+@lru_cache(maxsize=None)
+def country_colors(flow):
+    all_countries = tuple(sorted(load_clean(flow)["country"].dropna().unique()))
+    return _color_map(all_countries)
+
+@lru_cache(maxsize=None)
+def country_color_series(flow):
+    """
+    country_colors as a Series, for reindexing a whole column list at once
+    """
+    return pd.Series(country_colors(flow), dtype=object)
+
+# ================================================================
+# 4. Pivot helpers
+# ================================================================
+_MONTH_IDX = {m: i for i, m in enumerate(_cal.month_abbr) if m}
+
+# Labels repeat across every pivot, so each one is parsed only once
+@lru_cache(maxsize=512)
+def qtr_sort_key(lbl: str):
+    # Fixed "YYYY ..." layout: sliced directly, no regex
+    if len(lbl) < 7 or lbl[4] != " " or not lbl[:4].isdigit():
+        return (0, 0, 0)
+    year = int(lbl[:4])
+
+    # YYYY Qn
+    if len(lbl) == 7 and lbl[5] == "Q" and lbl[6] in "1234":
+        return (year, int(lbl[6]), 0)
+
+    # Running quarterly: YYYY Jan/Feb/Mar
+    mon = _MONTH_IDX.get(lbl[5:8].capitalize())
+    if mon:
+        q = (mon - 1) // 3 + 1
+        return (year, q, 1)
+
+    return (0, 0, 0)
+
+# Precomputed keys for canonical "YYYY Qn" labels (O(1) lookup);
+# anything else (running month labels) falls back to qtr_sort_key
+QTR_ORDER = [f"{y} Q{q}" for y in range(2000, 2100) for q in range(1, 5)]
+QTR_RANK = {lbl: (int(lbl[:4]), int(lbl[-1]), 0) for lbl in QTR_ORDER}
+
+def sort_pivot_index(pivot):
+    order = sorted(
+        pivot.index.tolist(),
+        key=lambda lbl: QTR_RANK.get(lbl) or qtr_sort_key(lbl)
+    )
+    return pivot.reindex(order)
+
+def order_by_total(pivot):
+    """
+    Columns in descending total order (ties keep their position), plus the
+    column totals in that order. Positional argsort, no label reindex.
+    """
+    col_totals = pivot.sum()
+    order = np.argsort(-col_totals.to_numpy(), kind="stable")
+    return pivot.iloc[:, order], col_totals.iloc[order]
+
+def row_pct(pivot):
+    """
+    Row-wise percent share in one numpy pass (all-zero rows stay 0, not NaN)
+    """
+    arr = pivot.to_numpy(dtype=float)
+    row_sums = arr.sum(axis=1, keepdims=True)
+    row_sums[row_sums == 0] = 1
+    return pd.DataFrame(arr * (100.0 / row_sums), index=pivot.index, columns=pivot.columns)
+
+# ================================================================
+# 5. Plot jobs + render pool
+# ================================================================
+def visible_columns(col_totals, label_thresh):
+    """
+    Countries worth drawing, in col_totals order: above label_thresh (or
+    all of them if none are), never all-zero
+    """
+    totals = col_totals.to_numpy()
+    mask = ((totals > label_thresh) | (totals <= label_thresh).all()) & (totals > 0)
+    return col_totals.index[mask]
+
+def plot_job(pivot, flow, title, ylabel, filename, fmt="{val}", label_thresh=10,
+             visible=None):
+    """
+    Package one plot for render_all: the pivot cut to its visible countries
+    plus their colours, i.e. only picklable inputs for a worker process.
+    Pass visible when the caller already has the column totals.
+    Returns None when no country is left to draw.
+    """
+    if visible is None:
+        visible = visible_columns(pivot.sum(axis=0), label_thresh)
+
+    # Nothing to draw (all-zero category): no figure, no PNG
+    if len(visible) == 0:
+        print(f"⏭ Skipping empty plot {filename}")
+        return None
+
+    colors = country_color_series(flow).reindex(visible, fill_value="#CCCCCC").tolist()
+    return (pivot[visible], colors, title, ylabel, str(EXPORT_DIR / filename), fmt,
+            label_thresh)
+
+@lru_cache(maxsize=None)
+def render_pool():
+    """
+    Process pool for rendering PNGs, started on first use and reused by
+    every run_plot_* call (workers start and import the plot modules once
+    per run, not once per call)
+    """
+    pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    atexit.register(pool.shutdown)
+    return pool
+
+def _render_one(item):
+    render, job = item
+    return render(*job)
+
+def render_all(render, jobs):
+    """
+    render(*job) for every packaged job (skipped plots dropped) across all
+    cores; render must be a module-level function so it pickles
+    """
+    jobs = [(render, job) for job in jobs if job is not None]
+    list(render_pool().map(_render_one, jobs, chunksize=4))
@@ -7,16 +7,27 @@ JP Trade Downloader (EXPORT + IMPORT) + Auto-Plot Pipeline Runner
 1. Downloads Japan HS10=8806 EXPORT **and** IMPORT data from e-Stat API
 2. Combines both flows into one dataset with column: flow ∈ {EXPORT, IMPORT}
 3. Validates dataset structure
-4. Saves unified CSV into drone-export-jp folder
+4. Saves unified Parquet file (optional CSV copy) into drone-export-jp folder
 5. Automatically triggers: jp_full_hs10_plot_script.py
+   (in-process; pass --subprocess to run it as a separate script)
 """
 
 import os
-import requests
+import orjson
+from requests_cache import CachedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 import sys
+import traceback
 
 # ================================================================
 # 0. CONFIG
@@ -29,6 +40,9 @@ TRADE_TYPES = {
     "IMPORT": "0003425294",
 }
 
+# Sorted, so the categorical flow column orders like the flow names
+FLOW_ORDER = sorted(TRADE_TYPES)
+
 BASE_URL_META = "https://api.e-stat.go.jp/rest/3.0/app/json/getMetaInfo"
 BASE_URL_DATA = "https://api.e-stat.go.jp/rest/3.0/app/json/getStatsData"
 
@@ -39,9 +53,39 @@ EXPORT_DIR = Path(
 ).expanduser()
 EXPORT_DIR.mkdir(parents=True, exist_ok=True)
 
-OUTPUT_FILE = EXPORT_DIR / "jp_trade_export_import_8806_monthly.csv"
+# Combined dataset as zstd Parquet (read back by jp_full_hs10_plot_script)
+OUTPUT_FILE = EXPORT_DIR / "jp_trade_export_import_8806_monthly.parquet"
+
+# Also write a human-readable CSV copy next to the Parquet file
+WRITE_CSV = False
+OUTPUT_CSV = OUTPUT_FILE.with_suffix(".csv")
 ENC = "utf-8-sig"
 
+# API responses cached on disk for a day: re-runs skip the download (once
+# expired, requests are revalidated with the server's ETag/Last-Modified).
+# e-Stat reports errors with HTTP 200, so decode_result evicts those.
+CACHE_FILE = EXPORT_DIR / ".estat_cache.sqlite"
+CACHE_EXPIRE = 86400
+
+# One keep-alive connection pool for every API call, sized for the
+# concurrent flow × year requests; gzip responses, transient errors retried
+SESSION = CachedSession(
+    str(CACHE_FILE),
+    backend="sqlite",
+    expire_after=CACHE_EXPIRE,
+    allowable_codes=(200,),
+)
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# (connect, read) seconds
+TIMEOUT = (5, 60)
+
 # ================================================================
 # HS10 Formatting
 # ================================================================
@@ -64,6 +108,15 @@ HS10_LIST = [
     "880699000",
 ]
 
+# getStatsData returns at most LIMIT records per request, so the HS10
+# codes are split into chunks of HS10_CHUNK, one request each
+# (cdCat01 parameter strings joined once)
+LIMIT = 100000
+HS10_CHUNK = 200
+CD_CAT01_CHUNKS = [
+    ",".join(HS10_LIST[i:i + HS10_CHUNK]) for i in range(0, len(HS10_LIST), HS10_CHUNK)
+]
+
 def format_hs10(hs):
     """
     Convert Japanese HS9 (e.g. '880692000') → HS10 formatted '8806.92.00.00'
@@ -76,11 +129,28 @@ def format_hs10(hs):
 # ================================================================
 # 1. FETCH METADATA (per flow)
 # ================================================================
+def decode_result(r, root, session=SESSION):
+    """
+    Decode an e-Stat JSON response. RESULT.STATUS 0-2 are normal
+    completions (1: no data, 2: some parameters ignored); 100+ are API
+    errors sent with HTTP 200: drop those from the cache (so the next run
+    asks again) and raise.
+    """
+    body = orjson.loads(r.content)
+    result = body.get(root, {}).get("RESULT", {})
+    status = int(result.get("STATUS", 0))
+    if status >= 100:
+        session.cache.delete(requests=[r.request])
+        raise RuntimeError(
+            f"e-Stat {root} returned STATUS {status}: {result.get('ERROR_MSG', '')}"
+        )
+    return body
+
 def get_meta(stats_id):
     params = {"appId": APP_ID, "statsDataId": stats_id, "lang": "J"}
-    r = requests.get(BASE_URL_META, params=params)
+    r = SESSION.get(BASE_URL_META, params=params, timeout=TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return decode_result(r, "GET_META_INFO")
 
 def extract_meta_maps(meta):
     class_objs = meta["GET_META_INFO"]["METADATA_INF"]["CLASS_INF"]["CLASS_OBJ"]
@@ -120,170 +190,281 @@ def extract_meta_maps(meta):
 # ================================================================
 # 2. FETCH YEAR (per flow)
 # ================================================================
-def fetch_year(year, stats_id, area_map, cat02_map, cat02_codes):
+# The four key attributes of a VALUE record, fetched in one C-level call
+get_keys = itemgetter("@cat01", "@area", "@time", "@cat02")
+
+def fetch_year(year, stats_id, cat02_map, cd_cat01, cd_cat02, session=SESSION):
+    """
+    One year × one chunk of HS10 codes, as an Arrow RecordBatch
+    """
     time_code = f"{year}000000"
     params = {
         "appId": APP_ID,
         "statsDataId": stats_id,
         "lang": "J",
         "cdTime": time_code,
-        "cdCat01": ",".join(HS10_LIST),
-        "cdCat02": ",".join(cat02_codes),
-        "limit": 100000,
+        "cdCat01": cd_cat01,
+        "cdCat02": cd_cat02,
+        "limit": LIMIT,
     }
 
-    r = requests.get(BASE_URL_DATA, params=params)
+    r = session.get(BASE_URL_DATA, params=params, timeout=TIMEOUT)
     r.raise_for_status()
-    js = r.json()
+    label = f"{year} in stats_id {stats_id}"
 
-    try:
-        values = js["GET_STATS_DATA"]["STATISTICAL_DATA"]["DATA_INF"]["VALUE"]
-    except KeyError:
-        raise RuntimeError(f"No VALUE found for {year} in stats_id {stats_id}")
-
-    if isinstance(values, dict):
-        values = [values]
-
-    rows = []
-    for v in values:
-        hs10 = v["@cat01"]
-        area_code = v["@area"]
-        time_code = v["@time"]
-        cat02_code = v["@cat02"]
+    # VALUE is a list of records, or a single record when only one matches
+    data = decode_result(r, "GET_STATS_DATA", session)["GET_STATS_DATA"]
+    records = data.get("STATISTICAL_DATA", {}).get("DATA_INF", {}).get("VALUE")
+    if records is None:
+        raise RuntimeError(f"No VALUE found for {label}")
+    if isinstance(records, dict):
+        records = [records]
+
+    # One list per output column (no per-row dicts; area_name is added
+    # per area after the pivot, not carried on every record)
+    years, months, hs10s, area_codes, vars_, vals = [], [], [], [], [], []
+
+    # cat02 code → (month, var): one lookup per record instead of two
+    cat02_flat = {k: (v["month"], v["var"]) for k, v in cat02_map.items()}
+
+    for v in records:
+        hs10, area_code, time_code, cat02_code = get_keys(v)
         value_str = v.get("$", v.get("#text", None))
         if value_str in (None, "", "-"):
             continue
 
-        try:
-            value = float(value_str)
-        except ValueError:
-            continue
-
-        if cat02_code not in cat02_map:
+        info = cat02_flat.get(cat02_code)
+        if info is None:
             continue
+        month, var = info
+
+        years.append(int(time_code[:4]))
+        months.append(month)
+        hs10s.append(format_hs10(hs10))
+        area_codes.append(area_code)
+        vars_.append(var)
+        vals.append(value_str)
+
+    # A full page means the API may have truncated the result
+    if len(records) >= LIMIT:
+        raise RuntimeError(
+            f"{len(records)} records for {label} reached limit={LIMIT}; lower HS10_CHUNK"
+        )
 
-        info = cat02_map[cat02_code]
+    # All values parsed in one C-level pass (no Python float per record);
+    # anything non-numeric becomes NaN and its row is dropped below
+    values = pd.to_numeric(np.array(vals, dtype=object), errors="coerce").astype(np.float64)
 
-        rows.append({
-            "year": int(time_code[:4]),
-            "month": info["month"],
-            "hs10": format_hs10(hs10),
-            "area_code": area_code,
-            "area_name": area_map.get(area_code, area_code),
-            "var": info["var"],
-            "value": value,
-        })
+    # One Arrow batch per request: narrow numeric types, low-cardinality
+    # strings dictionary-encoded (no Python object columns)
+    batch = pa.RecordBatch.from_arrays([
+        pa.array(years, type=pa.int16()),
+        pa.array(months, type=pa.int8()),
+        pa.array(hs10s, type=pa.string()).dictionary_encode(),
+        pa.array(area_codes, type=pa.string()).dictionary_encode(),
+        pa.array(vars_, type=pa.string()).dictionary_encode(),
+        pa.array(values, type=pa.float64()),
+    ], names=["year", "month", "hs10", "area_code", "var", "value"])
 
-    return pd.DataFrame(rows)
+    parsed = ~np.isnan(values)
+    return batch if parsed.all() else batch.filter(pa.array(parsed))
 
 # ================================================================
 # 3. MAIN DOWNLOAD (EXPORT + IMPORT)
 # ================================================================
-df_all_flows = []
-
-for flow, stats_id in TRADE_TYPES.items():
+def fetch_flow(flow, stats_id):
+    """
+    Metadata + all YEARS for one flow, pivoted to one row per
+    (year, month, area, hs10) with NO / KG / Yen_thousand columns
+    """
     print(f"\n=== 📦 Fetching {flow} metadata ===")
     meta = get_meta(stats_id)
-    
-
-    
     area_map, cat02_map, cat02_codes = extract_meta_maps(meta)
-
-    all_years = []
-    for y in YEARS:
-        print(f"📡 Fetching JP {flow} data for {y}...")
-        df_y = fetch_year(y, stats_id, area_map, cat02_map, cat02_codes)
-        all_years.append(df_y)
-
-    df_long = pd.concat(all_years, ignore_index=True)
+    # cdCat02 request parameter, joined once per flow instead of per year
+    cd_cat02 = ",".join(cat02_codes)
+
+    # Every year × HS10 chunk is an independent request: fetch them concurrently
+    print(f"📡 Fetching JP {flow} data for {', '.join(YEARS)}...")
+    jobs = [(y, cd_cat01) for y in YEARS for cd_cat01 in CD_CAT01_CHUNKS]
+    with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as ex:
+        batches = list(ex.map(
+            lambda req: fetch_year(req[0], stats_id, cat02_map, req[1], cd_cat02),
+            jobs
+        ))
+
+    # Request batches → one table, converted to pandas once; self_destruct frees
+    # each Arrow column as it is converted, so the data is never held twice.
+    # Dictionary columns arrive as categoricals in first-seen order; sort
+    # their categories so the final sort_values stays lexical.
+    table = pa.Table.from_batches(batches)
+    del batches
+    df_long = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    for c in df_long.select_dtypes("category").columns:
+        df_long[c] = df_long[c].cat.reorder_categories(sorted(df_long[c].cat.categories))
 
     # Pivot NO / KG / Yen
+    # (one value per key already, so a plain unstack — no aggregation pass)
     df_pivot = (
-        df_long.pivot_table(
-            index=["year", "month", "area_code", "area_name", "hs10"],
-            columns="var",
-            values="value",
-            aggfunc="first"
-        )
+        df_long.set_index(["year", "month", "area_code", "hs10", "var"])["value"]
+        .unstack("var")
         .reset_index()
     )
     df_pivot.columns.name = None
 
-    df_pivot = df_pivot.rename(columns={"NO": "NO", "KG": "KG", "YEN": "Yen_thousand"})
-    df_pivot["yyyymm"] = df_pivot["year"].astype(str) + df_pivot["month"].astype(str).str.zfill(2)
-
-    df_pivot["flow"] = flow
-    df_all_flows.append(df_pivot)
-
-# Combine EXPORT + IMPORT
-df_final = pd.concat(df_all_flows, ignore_index=True)
-
-df_final = df_final[
-    [
-        "flow",
-        "yyyymm",
-        "year",
-        "month",
-        "area_code",
-        "area_name",
-        "hs10",
-        "NO",
-        "KG",
-        "Yen_thousand",
-    ]
-].sort_values(["flow", "year", "month", "area_code", "hs10"])
-
-# ================================================================
-# 4. VALIDATION CHECKS
-# ================================================================
-print("\n🔍 Running validation checks...")
-
-required_cols = [
-    "flow","yyyymm","year","month","area_code","area_name",
-    "hs10","NO","KG","Yen_thousand"
-]
-
-missing_cols = [c for c in required_cols if c not in df_final.columns]
-if missing_cols:
-    print("❌ Missing required columns:", missing_cols)
-    sys.exit(1)
-
-if df_final.empty:
-    print("❌ ERROR: Combined dataset is empty.")
-    sys.exit(1)
-
-bad_yyyymm = df_final[~df_final["yyyymm"].str.match(r"^\d{6}$")]
-if not bad_yyyymm.empty:
-    print("❌ Invalid yyyymm values found:")
-    print(bad_yyyymm.head())
-    sys.exit(1)
+    # area_name looked up once per distinct area code, not once per record
+    names = {c: area_map.get(c, c) for c in df_pivot["area_code"].cat.categories}
+    df_pivot["area_name"] = df_pivot["area_code"].map(names).astype("category")
 
-print("✅ Validation passed.")
+    df_pivot = df_pivot.rename(columns={"NO": "NO", "KG": "KG", "YEN": "Yen_thousand"})
+    # Kept as int32 (YYYYMM); written as the same 6 digits in the CSV
+    df_pivot["yyyymm"] = (
+        df_pivot["year"].to_numpy(dtype=np.int32) * 100
+        + df_pivot["month"].to_numpy(dtype=np.int32)
+    )
 
-# ================================================================
-# 5. SAVE FINAL OUTPUT
-# ================================================================
-print(f"\n💾 Saving JP combined trade file to {OUTPUT_FILE}")
-df_final.to_csv(OUTPUT_FILE, index=False, encoding=ENC)
+    # Categorical over every flow, so the combined frame sorts on codes
+    df_pivot["flow"] = pd.Categorical.from_codes(
+        np.full(len(df_pivot), FLOW_ORDER.index(flow), dtype=np.int8),
+        categories=FLOW_ORDER,
+    )
+    return df_pivot
+
+def main():
+    # EXPORT and IMPORT are independent tables: fetch both at once
+    with ThreadPoolExecutor(max_workers=len(TRADE_TYPES)) as ex:
+        df_all_flows = list(ex.map(fetch_flow, TRADE_TYPES.keys(), TRADE_TYPES.values()))
+
+    # Combine EXPORT + IMPORT
+    # Give both flows the same sorted categories so the key columns stay
+    # categorical through the concat (mismatched categories fall back to object)
+    for c in ("area_code", "area_name", "hs10"):
+        cats = sorted(set().union(*(df[c].cat.categories for df in df_all_flows)))
+        for df in df_all_flows:
+            df[c] = df[c].cat.set_categories(cats)
+
+    df_final = pd.concat(df_all_flows, ignore_index=True)
+
+    df_final = df_final[
+        [
+            "flow",
+            "yyyymm",
+            "year",
+            "month",
+            "area_code",
+            "area_name",
+            "hs10",
+            "NO",
+            "KG",
+            "Yen_thousand",
+        ]
+    ]
 
-print("✅ JP trade CSV saved.")
+    # Sort by flow, year, month, area_code, hs10 on the integer keys: the
+    # categorical codes follow the sorted categories, so this is the lexical
+    # order (np.lexsort is stable and takes its primary key last)
+    order = np.lexsort([
+        df_final["hs10"].cat.codes.to_numpy(),
+        df_final["area_code"].cat.codes.to_numpy(),
+        df_final["month"].to_numpy(),
+        df_final["year"].to_numpy(),
+        df_final["flow"].cat.codes.to_numpy(),
+    ])
+    df_final = df_final.take(order).reset_index(drop=True)
+
+    # ================================================================
+    # 4. VALIDATION CHECKS
+    # ================================================================
+    print("\n🔍 Running validation checks...")
+
+    required_cols = [
+        "flow","yyyymm","year","month","area_code","area_name",
+        "hs10","NO","KG","Yen_thousand"
+    ]
 
-# ================================================================
-# 6. AUTO-RUN VISUALIZATION PIPELINE
-# ================================================================
-print("\n🚀 Running jp_full_hs10_plot_script.py ...")
+    missing_cols = [c for c in required_cols if c not in df_final.columns]
+    if missing_cols:
+        print("❌ Missing required columns:", missing_cols)
+        sys.exit(1)
+
+    if df_final.empty:
+        print("❌ ERROR: Combined dataset is empty.")
+        sys.exit(1)
+
+    # Six-digit YYYYMM as a plain integer range check
+    yyyymm = df_final["yyyymm"].to_numpy()
+    bad_yyyymm = df_final[(yyyymm < 100000) | (yyyymm >= 1000000)]
+    if not bad_yyyymm.empty:
+        print("❌ Invalid yyyymm values found:")
+        print(bad_yyyymm.head())
+        sys.exit(1)
+
+    print("✅ Validation passed.")
+
+    # ================================================================
+    # 5. SAVE FINAL OUTPUT
+    # ================================================================
+    print(f"\n💾 Saving JP combined trade file to {OUTPUT_FILE}")
+    table = pa.Table.from_pandas(df_final, preserve_index=False)
+    pq.write_table(table, OUTPUT_FILE, compression="zstd", compression_level=3)
+
+    # Subprocess fallback (--subprocess): the plot script only needs the
+    # Parquet file, so it is started now and its interpreter start-up
+    # overlaps the CSV copy below
+    proc = None
+    if "--subprocess" in sys.argv[1:]:
+        try:
+            proc = subprocess.Popen(
+                ["python", str(EXPORT_DIR / "jp_full_hs10_plot_script.py")],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+        except Exception as e:
+            print("❌ Failed to run jp_full_hs10_plot_script.py")
+            print(e)
+            sys.exit(1)
+
+    if WRITE_CSV:
+        # Arrow's C++ CSV writer; the BOM is written first to keep the
+        # utf-8-sig encoding (ENC) that Excel needs for the Japanese area names
+        with open(OUTPUT_CSV, "wb") as f:
+            f.write("".encode(ENC))
+            pa_csv.write_csv(
+                table,
+                f,
+                write_options=pa_csv.WriteOptions(quoting_style="needed"),
+            )
+        print(f"💾 Saved: {OUTPUT_CSV}")
+
+    print("✅ JP trade file saved.")
+
+    # ================================================================
+    # 6. AUTO-RUN VISUALIZATION PIPELINE
+    # ================================================================
+    print("\n🚀 Running jp_full_hs10_plot_script.py ...")
 
-try:
-    result = subprocess.run(
-        ["python", str(EXPORT_DIR / "jp_full_hs10_plot_script.py")],
-        capture_output=True,
-        text=True
-    )
-    print(result.stdout)
-    print(result.stderr)
-except Exception as e:
-    print("❌ Failed to run jp_full_hs10_plot_script.py")
-    print(e)
-    sys.exit(1)
-
-print("🎉 All JP plots generated successfully.")
+    try:
+        if proc is not None:
+            stdout, stderr = proc.communicate()
+            print(stdout)
+            print(stderr)
+        else:
+            # In-process: no second interpreter start-up or pandas/matplotlib
+            # import, and the table just written is cleaned without
+            # re-reading it from disk
+            sys.path.insert(0, str(EXPORT_DIR))
+            import jp_full_hs10_plot_script
+            jp_full_hs10_plot_script.main(table)
+    except Exception:
+        # Full traceback: in-process failures have no child stderr to show
+        print("❌ Failed to run jp_full_hs10_plot_script.py")
+        traceback.print_exc()
+        sys.exit(1)
+
+    print("🎉 All JP plots generated successfully.")
+
+
+# Guarded so plot worker processes can import this module safely
+if __name__ == "__main__":
+    main()